@@ -1,6 +1,8 @@
 # app.py
 import streamlit as st
-import sqlite3, os, io, datetime
+import sqlite3, os, io, datetime, threading, time, hashlib, hmac
+from contextlib import contextmanager
+import numpy as np
 import pandas as pd
 import plotly.express as px
 from PIL import Image
@@ -10,67 +12,147 @@ from PIL import Image
 # ----------------------------
 DB_PATH = "oncf.db"
 UPLOAD_DIR = "uploads"
+PHOTO_MAX_SIZE = (1280, 1280)
+ANOMALIES_PAGE_SIZE = 500
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 
+@st.cache_resource
 def get_conn():
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    # single shared connection, kept alive across Streamlit reruns (autocommit mode)
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None, cached_statements=256)
+    conn.executescript(
+        "PRAGMA journal_mode=WAL;"
+        "PRAGMA synchronous=NORMAL;"
+        "PRAGMA temp_store=MEMORY;"
+        "PRAGMA mmap_size=268435456;"
+        "PRAGMA cache_size=-20000;"
+    )
     return conn
 
-def init_db():
+@st.cache_resource
+def get_write_lock():
+    # the connection is shared between sessions: serialize write transactions on it
+    return threading.RLock()
+
+@contextmanager
+def transaction():
+    """
+    Run the enclosed writes as one BEGIN IMMEDIATE ... COMMIT (ROLLBACK on error),
+    i.e. a single fsync per user action instead of one per statement.
+    """
     conn = get_conn()
-    c = conn.cursor()
-    # users (demo)
-    c.execute("""CREATE TABLE IF NOT EXISTS users (
-        username TEXT PRIMARY KEY, password TEXT, role TEXT, fullname TEXT
-    )""")
-    # trains
-    c.execute("""CREATE TABLE IF NOT EXISTS trains (
-        id_train TEXT PRIMARY KEY, modele TEXT, date_mise_en_service TEXT,
-        km_total INTEGER, etat_sante INTEGER, derniere_visite TEXT
-    )""")
-    # components (criticité_max)
-    c.execute("""CREATE TABLE IF NOT EXISTS components (
-        name TEXT PRIMARY KEY, criticite_max INTEGER
-    )""")
-    # parts
-    c.execute("""CREATE TABLE IF NOT EXISTS parts (
-        ref TEXT PRIMARY KEY, designation TEXT, qty INTEGER, seuil_min INTEGER, utilises TEXT
-    )""")
-    # anomalies
-    c.execute("""CREATE TABLE IF NOT EXISTS anomalies (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        id_train TEXT, technicien TEXT, date_signalement TEXT,
-        categorie TEXT, composant TEXT, description TEXT, photo TEXT,
-        immobilisation INTEGER, gravite TEXT, criticite_calc INTEGER, urgence TEXT, statut TEXT
-    )""")
-    # conformities
-    c.execute("""CREATE TABLE IF NOT EXISTS conformities (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        id_train TEXT, date_intervention TEXT, technicien TEXT,
-        type_intervention TEXT, composant TEXT, piece_ref TEXT, resultat TEXT, observations TEXT
-    )""")
-    conn.commit()
-
-    # seed demo users/trains/components/parts if not exist
-    c.execute("SELECT COUNT(*) FROM users")
-    if c.fetchone()[0] == 0:
+    with get_write_lock():
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+            conn.execute("COMMIT")
+        except BaseException:
+            # also covers a failed COMMIT: never leave the shared connection inside a transaction
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+
+@st.cache_resource
+def _db_gen():
+    # shared by all sessions, so a write in one session invalidates cached reads in the others
+    return [0]
+
+def get_db_gen():
+    return _db_gen()[0]
+
+def bump_db_gen():
+    """Call after any INSERT/UPDATE so st.cache_data readers keyed on get_db_gen() reload."""
+    with get_write_lock():
+        _db_gen()[0] += 1
+
+def hash_password(password, salt):
+    return hashlib.scrypt(password.encode(), salt=salt, n=2**14, r=8, p=1, dklen=32)
+
+DUMMY_SALT = bytes(16)
+DUMMY_HASH = bytes(32)
+
+@st.cache_resource
+def init_db():
+    # schema, migrations and seeds: once per server process, not on every rerun
+    with transaction() as conn:
+        c = conn.cursor()
+        # users (demo)
+        c.execute("""CREATE TABLE IF NOT EXISTS users (
+            username TEXT PRIMARY KEY, password_hash BLOB, salt BLOB, role TEXT, fullname TEXT
+        )""")
+        # passwords used to be stored in clear: hash them on existing databases
+        cols = {r[1] for r in c.execute("PRAGMA table_info(users)")}
+        if "password_hash" not in cols:
+            c.execute("ALTER TABLE users ADD COLUMN password_hash BLOB")
+            c.execute("ALTER TABLE users ADD COLUMN salt BLOB")
+        if "password" in cols:
+            for username, password in c.execute("SELECT username, password FROM users WHERE password IS NOT NULL").fetchall():
+                salt = os.urandom(16)
+                c.execute("UPDATE users SET password_hash=?, salt=?, password=NULL WHERE username=?",
+                          (hash_password(password, salt), salt, username))
+        # trains
+        c.execute("""CREATE TABLE IF NOT EXISTS trains (
+            id_train TEXT PRIMARY KEY, modele TEXT, date_mise_en_service TEXT,
+            km_total INTEGER, etat_sante INTEGER, derniere_visite TEXT,
+            sum_crit INTEGER DEFAULT 0, n_anom INTEGER DEFAULT 0, window_start TEXT
+        )""")
+        # health counters were added later: migrate existing databases
+        cols = {r[1] for r in c.execute("PRAGMA table_info(trains)")}
+        for col, decl in (("sum_crit", "INTEGER DEFAULT 0"), ("n_anom", "INTEGER DEFAULT 0"), ("window_start", "TEXT")):
+            if col not in cols:
+                c.execute(f"ALTER TABLE trains ADD COLUMN {col} {decl}")
+        # components (criticité_max)
+        c.execute("""CREATE TABLE IF NOT EXISTS components (
+            name TEXT PRIMARY KEY, criticite_max INTEGER
+        )""")
+        # parts
+        c.execute("""CREATE TABLE IF NOT EXISTS parts (
+            ref TEXT PRIMARY KEY, designation TEXT, qty INTEGER, seuil_min INTEGER, utilises TEXT
+        )""")
+        # anomalies
+        c.execute("""CREATE TABLE IF NOT EXISTS anomalies (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            id_train TEXT, technicien TEXT, date_signalement TEXT,
+            categorie TEXT, composant TEXT, description TEXT, photo TEXT,
+            immobilisation INTEGER, gravite TEXT, criticite_calc INTEGER, urgence TEXT, statut TEXT,
+            ts INTEGER DEFAULT (strftime('%s', 'now'))
+        )""")
+        # conformities
+        c.execute("""CREATE TABLE IF NOT EXISTS conformities (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            id_train TEXT, date_intervention TEXT, technicien TEXT,
+            type_intervention TEXT, composant TEXT, piece_ref TEXT, resultat TEXT, observations TEXT
+        )""")
+        # epoch ts was added later (date_signalement is kept for display): migrate existing databases
+        if "ts" not in {r[1] for r in c.execute("PRAGMA table_info(anomalies)")}:
+            c.execute("ALTER TABLE anomalies ADD COLUMN ts INTEGER")
+            c.execute("UPDATE anomalies SET ts = CAST(strftime('%s', date_signalement) AS INTEGER)")
+        # indexes for the 90-day window lookups (criticity frequency, train health)
+        c.execute("DROP INDEX IF EXISTS idx_anom_train_comp_date")
+        c.execute("DROP INDEX IF EXISTS idx_anom_train_date")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_anom_train_comp_ts ON anomalies(id_train, composant, ts)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_anom_train_ts ON anomalies(id_train, ts)")
+
+        # seed demo users/trains/components/parts (idempotent: existing keys are left untouched)
         users = [
             ("tech", "password", "technicien", "Technicien Demo"),
             ("responsable", "password", "responsable", "Responsable Demo")
         ]
-        c.executemany("INSERT INTO users (username,password,role,fullname) VALUES (?,?,?,?)", users)
-    # seed trains
-    c.execute("SELECT COUNT(*) FROM trains")
-    if c.fetchone()[0] == 0:
+        # scrypt is deliberately slow: only hash the demo users that are actually missing
+        existing = {r[0] for r in c.execute("SELECT username FROM users")}
+        for username, password, role, fullname in users:
+            if username not in existing:
+                salt = os.urandom(16)
+                c.execute("INSERT INTO users (username,password_hash,salt,role,fullname) VALUES (?,?,?,?,?)",
+                          (username, hash_password(password, salt), salt, role, fullname))
+        # seed trains
         trains = [
             ("Z2M-01","Z2M", "2010-05-20", 450000, 100, ""),
             ("Z2M-05","Z2M", "2011-07-12", 512000, 100, ""),
             ("Z2M-08","Z2M", "2009-03-03", 600000, 100, "")
         ]
-        c.executemany("INSERT INTO trains (id_train,modele,date_mise_en_service,km_total,etat_sante,derniere_visite) VALUES (?,?,?,?,?,?)", trains)
-    # seed components (AMDEC criticite)
-    c.execute("SELECT COUNT(*) FROM components")
-    if c.fetchone()[0] == 0:
+        c.executemany("INSERT OR IGNORE INTO trains (id_train,modele,date_mise_en_service,km_total,etat_sante,derniere_visite) VALUES (?,?,?,?,?,?)", trains)
+        # seed components (AMDEC criticite)
         comps = [
             ("frein", 95),
             ("porte", 80),
@@ -80,18 +162,14 @@ def init_db():
             ("batterie", 70),
             ("pantographe", 88)
         ]
-        c.executemany("INSERT INTO components (name,criticite_max) VALUES (?,?)", comps)
-    # seed parts
-    c.execute("SELECT COUNT(*) FROM parts")
-    if c.fetchone()[0] == 0:
+        c.executemany("INSERT OR IGNORE INTO components (name,criticite_max) VALUES (?,?)", comps)
+        # seed parts
         parts = [
             ("VP001","Valve de pression", 4, 2, "frein,hydraulique"),
             ("VR003","Vérin porte", 2, 1, "porte"),
             ("PLT10","Plaquette de frein", 20, 5, "frein")
         ]
-        c.executemany("INSERT INTO parts (ref,designation,qty,seuil_min,utilises) VALUES (?,?,?,?,?)", parts)
-    conn.commit()
-    conn.close()
+        c.executemany("INSERT OR IGNORE INTO parts (ref,designation,qty,seuil_min,utilises) VALUES (?,?,?,?,?)", parts)
 
 init_db()
 
@@ -101,30 +179,68 @@ init_db()
 def parse_dt(s):
     return datetime.datetime.fromisoformat(s)
 
+def to_iso(now):
+    # dates are stored as naive UTC ISO strings (the format used since the first release)
+    return now.replace(tzinfo=None).isoformat()
+
 def now_iso():
-    return datetime.datetime.utcnow().isoformat()
+    return to_iso(datetime.datetime.now(datetime.timezone.utc))
 
 def days_ago_iso(days):
-    return (datetime.datetime.utcnow() - datetime.timedelta(days=days)).isoformat()
+    return to_iso(datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=days))
+
+def days_ago_ts(days):
+    return int(time.time()) - days * 86400
+
+@st.cache_resource
+def load_component_criticites():
+    # AMDEC lookup is static at runtime: read it once, call .clear() if components are ever edited
+    return dict(get_conn().execute("SELECT name, criticite_max FROM components"))
 
 def get_component_criticite(name):
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("SELECT criticite_max FROM components WHERE name = ?", (name,))
-    r = c.fetchone()
-    conn.close()
-    return int(r[0]) if r else 50
+    return int(load_component_criticites().get(name, 50))
 
 def count_similar_recent(train_id, composant, days=90):
     conn = get_conn()
     c = conn.cursor()
-    since = days_ago_iso(days)
-    c.execute("SELECT COUNT(*) FROM anomalies WHERE id_train=? AND composant=? AND date_signalement>=?", (train_id, composant, since))
+    since = days_ago_ts(days)
+    c.execute("SELECT COUNT(*) FROM anomalies WHERE id_train=? AND composant=? AND ts>=?", (train_id, composant, since))
     n = c.fetchone()[0]
-    conn.close()
     return n
 
-def compute_criticite_calc(train_id, composant, gravite, immobilisation):
+@st.cache_resource
+def _similar_recent_cache():
+    # {(train_id, composant, minute): count}, shared by all sessions
+    return {}
+
+def count_similar_recent_cached(train_id, composant, minute):
+    """
+    count_similar_recent(..., days=90) memoized per minute bucket: technicians often log several
+    anomalies in a burst. note_similar_recent() keeps the cached counts exact after an insert;
+    callers hold get_write_lock() from this lookup until that update.
+    """
+    cache = _similar_recent_cache()
+    key = (train_id, composant, minute)
+    if key not in cache:
+        if len(cache) >= 256:
+            cache.clear()
+        cache[key] = count_similar_recent(train_id, composant, days=90)
+    return cache[key]
+
+def note_similar_recent(train_id, composant):
+    # every cached bucket of this pair was filled before the insert committed (the write lock is
+    # held throughout), so all of them are missing exactly this row, whatever minute they key on
+    cache = _similar_recent_cache()
+    for key in cache:
+        if key[:2] == (train_id, composant):
+            cache[key] += 1
+
+GRAV_MAP = {"Urgent": 1.0, "Moyen": 0.6, "Faible": 0.3}
+
+def urgence_from_criticite(crit_calc):
+    return "critique" if crit_calc >= 80 else ("moyenne" if crit_calc >= 50 else "faible")
+
+def compute_criticite_calc(train_id, composant, gravite, immobilisation, minute=None):
     """
     Compute criticity calculation (0-100) using:
     - criticite_max from AMDEC
@@ -134,9 +250,10 @@ def compute_criticite_calc(train_id, composant, gravite, immobilisation):
     Weighted sum -> criticite_calc
     """
     criticite_max = get_component_criticite(composant)
-    grav_map = {"Urgent":1.0, "Moyen":0.6, "Faible":0.3}
-    grav = grav_map.get(gravite, 0.6)
-    occ = count_similar_recent(train_id, composant, days=90)
+    grav = GRAV_MAP.get(gravite, 0.6)
+    if minute is None:
+        minute = int(time.time() // 60)
+    occ = count_similar_recent_cached(train_id, composant, minute)
     freq_factor = min(1.0, occ / 5.0)  # saturates at 1 after 5 occurrences
     imm = 1.0 if immobilisation else 0.6
     # weights chosen: 0.5 for component criticality baseline, 0.3 for grav + imm, 0.2 for frequency
@@ -146,6 +263,27 @@ def compute_criticite_calc(train_id, composant, gravite, immobilisation):
     score = max(0, min(100, round(score)))
     return int(score)
 
+# trains keep running counters (sum_crit, n_anom) of their anomalies since window_start,
+# so an insert only bumps them; health is derived from the counters in SQL
+def health_sql(n, s):
+    return f"""CASE WHEN {n} = 0 THEN 100
+    ELSE CAST(ROUND(MAX(0.0, MIN(100.0, 100.0 - ({s} / ({n} * 100.0)) * 100.0))) AS INTEGER) END"""
+
+def rebuild_health_counters(days_window, train_id=None):
+    """Recount sum_crit/n_anom from the anomalies table (one train, or all if train_id is None)."""
+    only = "WHERE t.id_train = :train" if train_id is not None else ""
+    params = {"since_ts": days_ago_ts(days_window), "since": days_ago_iso(days_window), "train": train_id}
+    # one grouped aggregate over the window; the LEFT JOIN resets trains without recent anomalies to 0
+    get_conn().execute(f"""UPDATE trains SET
+        n_anom = w.n, sum_crit = w.s, etat_sante = {health_sql("w.n", "w.s")}, window_start = :since
+        FROM (
+            SELECT t.id_train, COUNT(a.id) AS n, COALESCE(SUM(a.criticite_calc), 0) AS s
+            FROM trains t LEFT JOIN anomalies a ON a.id_train = t.id_train AND a.ts >= :since_ts
+            {only}
+            GROUP BY t.id_train
+        ) AS w
+        WHERE trains.id_train = w.id_train""", params)
+
 def recalc_train_health(train_id, days_window=90):
     """
     Health formula:
@@ -153,41 +291,33 @@ def recalc_train_health(train_id, days_window=90):
     if n==0 -> health = 100
     return int rounded health between 0..100
     """
-    conn = get_conn()
-    c = conn.cursor()
-    since = days_ago_iso(days_window)
-    c.execute("SELECT criticite_calc FROM anomalies WHERE id_train=? AND date_signalement>=?", (train_id, since))
-    rows = c.fetchall()
-    conn.close()
-    if not rows:
-        health = 100
-    else:
-        n = len(rows)
-        s = sum([r[0] for r in rows])
-        max_possible = n * 100
-        if max_possible == 0:
-            health = 100
-        else:
-            fraction = s / max_possible
-            health_f = 100.0 - (fraction * 100.0)
-            health = int(round(max(0.0, min(100.0, health_f))))
-    # update DB
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("UPDATE trains SET etat_sante=? WHERE id_train=?", (health, train_id))
-    conn.commit()
-    conn.close()
-    return health
+    rebuild_health_counters(days_window, train_id)
+    r = get_conn().execute("SELECT etat_sante FROM trains WHERE id_train=?", (train_id,)).fetchone()
+    return r[0] if r else 100
+
+def add_anomaly_health(train_id, crit_calc):
+    """O(1) health update for a newly inserted anomaly: bump the counters instead of rescanning."""
+    # SET expressions see the old row, so etat_sante is derived from the incremented counters inline
+    rows = get_conn().execute(f"""UPDATE trains SET
+        sum_crit = sum_crit + :c, n_anom = n_anom + 1,
+        etat_sante = {health_sql("(n_anom + 1)", "(sum_crit + :c)")}
+        WHERE id_train = :t RETURNING etat_sante""", {"c": crit_calc, "t": train_id}).fetchall()
+    return rows[0][0] if rows else 100
 
 # convenience: recalc all
-def recalc_all_trains():
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("SELECT id_train FROM trains")
-    trains = [r[0] for r in c.fetchall()]
-    conn.close()
-    for t in trains:
-        recalc_train_health(t)
+def recalc_all_trains(days_window=90):
+    with transaction():
+        rebuild_health_counters(days_window)
+
+def roll_health_window(days_window=90):
+    """Rebuild all counters at most once a day, when the window start has moved past window_start."""
+    cutoff_day = days_ago_iso(days_window)[:10]
+    stale = get_conn().execute("SELECT 1 FROM trains WHERE window_start IS NULL OR window_start < ? LIMIT 1", (cutoff_day,)).fetchone()
+    if stale:
+        recalc_all_trains(days_window)
+        bump_db_gen()
+
+roll_health_window()
 
 # ----------------------------
 # Streamlit UI
@@ -204,10 +334,12 @@ if 'auth' not in st.session_state:
 def login(username, password):
     conn = get_conn()
     c = conn.cursor()
-    c.execute("SELECT role FROM users WHERE username=? AND password=?", (username, password))
+    c.execute("SELECT role, salt, password_hash FROM users WHERE username=?", (username,))
     r = c.fetchone()
-    conn.close()
-    if r:
+    # unknown users still pay for one scrypt run, so timing doesn't reveal which usernames exist
+    salt, expected = (r[1], r[2]) if r and r[2] is not None else (DUMMY_SALT, DUMMY_HASH)
+    ok = hmac.compare_digest(hash_password(password, salt), expected)
+    if ok and expected is not DUMMY_HASH:
         st.session_state['auth'] = True
         st.session_state['user'] = username
         st.session_state['role'] = r[0]
@@ -257,10 +389,44 @@ else:
 
 # small helper to fetch tables
 def df_from_query(q, params=()):
-    conn = get_conn()
-    df = pd.read_sql_query(q, conn, params=params)
-    conn.close()
-    return df
+    return pd.read_sql_query(q, get_conn(), params=params)
+
+# cached reads, keyed on the write generation (ttl bounds staleness when the 90-day window rolls)
+@st.cache_data(ttl=30, show_spinner=False)
+def load_trains_health(gen):
+    return df_from_query("SELECT id_train, etat_sante FROM trains")
+
+@st.cache_data(ttl=30, show_spinner=False)
+def load_fleet_kpis(gen):
+    """(bad, medium, good, total) train counts by health band."""
+    return get_conn().execute("""SELECT COALESCE(SUM(etat_sante < 50), 0), COALESCE(SUM(etat_sante BETWEEN 50 AND 79), 0),
+        COALESCE(SUM(etat_sante >= 80), 0), COUNT(*) FROM trains""").fetchone()
+
+@st.cache_data(ttl=30, show_spinner=False)
+def load_anomaly_kpis(gen):
+    """(total, open) anomaly counts."""
+    return get_conn().execute("SELECT COUNT(*), COALESCE(SUM(statut != 'résolu'), 0) FROM anomalies").fetchone()
+
+@st.cache_data(ttl=30, show_spinner=False)
+def list_categories(gen):
+    return [r[0] for r in get_conn().execute("SELECT DISTINCT categorie FROM anomalies ORDER BY categorie")]
+
+@st.cache_data(ttl=30, show_spinner=False)
+def load_anomalies_by_categorie(gen):
+    return df_from_query("SELECT categorie, COUNT(*) AS count FROM anomalies GROUP BY categorie")
+
+# selectbox option lists (reference tables, not edited from the app)
+@st.cache_data(ttl=300, show_spinner=False)
+def list_trains():
+    return [r[0] for r in get_conn().execute("SELECT id_train FROM trains")]
+
+@st.cache_data(ttl=300, show_spinner=False)
+def list_components():
+    return [r[0] for r in get_conn().execute("SELECT name FROM components")]
+
+@st.cache_data(ttl=300, show_spinner=False)
+def list_parts():
+    return [f"{ref} - {des}" for ref, des in get_conn().execute("SELECT ref, designation FROM parts")]
 
 # ----------------------------
 # TECHNICIEN PAGES
@@ -277,45 +443,51 @@ if role == "technicien" and page == "Accueil":
 if role == "technicien" and page == "Nouvelle anomalie":
     st.header("Déclarer une nouvelle anomalie")
     # form
-    conn = get_conn()
-    trains = pd.read_sql_query("SELECT id_train FROM trains", conn)['id_train'].tolist()
-    conn.close()
+    trains = list_trains()
     with st.form("anomaly_form", clear_on_submit=True):
         sid = st.selectbox("Train", trains)
         cat = st.selectbox("Catégorie", ["mécanique", "électrique", "climatisation", "autre"])
         # components list from DB
-        conn = get_conn()
-        comps = pd.read_sql_query("SELECT name FROM components", conn)['name'].tolist()
-        conn.close()
-        comp = st.selectbox("Composant", comps)
+        comp = st.selectbox("Composant", list_components())
         desc = st.text_area("Description")
         photo_file = st.file_uploader("Photo (optionnelle)", type=["png","jpg","jpeg"])
         immobil = st.checkbox("Immobilisation due à la panne (train immobilisé)?")
         grav = st.selectbox("Gravité perçue", ["Urgent","Moyen","Faible"])
         submitted = st.form_submit_button("Enregistrer anomalie")
         if submitted:
+            now = datetime.datetime.now(datetime.timezone.utc)
             # save photo
             photo_path = ""
             if photo_file:
-                saved_path = os.path.join(UPLOAD_DIR, f"{int(datetime.datetime.utcnow().timestamp())}_{photo_file.name}")
+                # stored as a downsized JPEG whatever the upload format
+                base = os.path.splitext(photo_file.name)[0]
+                saved_path = os.path.join(UPLOAD_DIR, f"{int(now.timestamp())}_{base}.jpg")
                 img = Image.open(photo_file)
-                img.save(saved_path)
+                img.draft("RGB", PHOTO_MAX_SIZE)  # JPEG only: let libjpeg downscale while decoding
+                img = img.convert("RGB")
+                img.thumbnail(PHOTO_MAX_SIZE, Image.LANCZOS)
+                img.save(saved_path, format="JPEG", quality=85, optimize=True, progressive=True)
                 photo_path = saved_path
-            # compute criticity
-            crit_calc = compute_criticite_calc(sid, comp, grav, immobil)
-            urgence = "critique" if crit_calc >= 80 else ("moyenne" if crit_calc >= 50 else "faible")
-            # insert
-            conn = get_conn()
-            c = conn.cursor()
-            c.execute("""INSERT INTO anomalies (
-                id_train, technicien, date_signalement, categorie, composant, description, photo,
-                immobilisation, gravite, criticite_calc, urgence, statut
-            ) VALUES (?,?,?,?,?,?,?,?,?,?,?,?)""",
-            (sid, user, now_iso(), cat, comp, desc, photo_path, 1 if immobil else 0, grav, crit_calc, urgence, "à traiter"))
-            conn.commit()
-            conn.close()
-            # recalc health immediately
-            new_health = recalc_train_health(sid)
+            # the write lock spans the cached count lookup, the insert and the cache update,
+            # so concurrent sessions never see a count missing a committed anomaly
+            minute = int(now.timestamp() // 60)
+            with get_write_lock():
+                with transaction() as conn:
+                    # compute criticity
+                    crit_calc = compute_criticite_calc(sid, comp, grav, immobil, minute)
+                    urgence = urgence_from_criticite(crit_calc)
+                    # insert
+                    c = conn.cursor()
+                    c.execute("""INSERT INTO anomalies (
+                        id_train, technicien, date_signalement, categorie, composant, description, photo,
+                        immobilisation, gravite, criticite_calc, urgence, statut, ts
+                    ) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)""",
+                    (sid, user, to_iso(now), cat, comp, desc, photo_path, 1 if immobil else 0, grav, crit_calc, urgence, "à traiter", int(now.timestamp())))
+                    # update health immediately
+                    new_health = add_anomaly_health(sid, crit_calc)
+                # only once committed: a rolled-back insert must not inflate the cached count
+                note_similar_recent(sid, comp)
+            bump_db_gen()
             st.success(f"Anomalie enregistrée — criticité calculée = {crit_calc}. État santé du train recalculé = {new_health}%")
             st.info("L'anomalie est visible dans la liste des anomalies.")
 
@@ -329,65 +501,55 @@ if role == "technicien" and page == "Mes anomalies":
         c = conn.cursor()
         c.execute("SELECT id, id_train, description, statut FROM anomalies WHERE id=?", (sel,))
         r = c.fetchone()
-        conn.close()
         if r:
             st.write("Anomalie sélectionnée:", r)
             col1, col2 = st.columns(2)
             with col1:
                 if st.button("Marquer comme en cours"):
-                    conn = get_conn(); c = conn.cursor()
-                    c.execute("UPDATE anomalies SET statut='en cours' WHERE id=?", (sel,)); conn.commit(); conn.close()
+                    with transaction() as conn:
+                        conn.execute("UPDATE anomalies SET statut='en cours' WHERE id=?", (sel,))
+                    bump_db_gen()
                     st.success("Statut mis à jour.")
             with col2:
                 if st.button("Marquer comme résolu"):
-                    conn = get_conn(); c = conn.cursor()
-                    c.execute("UPDATE anomalies SET statut='résolu' WHERE id=?", (sel,)); conn.commit(); conn.close()
-                    # optionally recalc health for train
-                    # find train id
-                    conn = get_conn(); c = conn.cursor()
-                    c.execute("SELECT id_train FROM anomalies WHERE id=?", (sel,))
-                    tid = c.fetchone()[0]
-                    conn.close()
-                    recalc_train_health(tid)
+                    with transaction() as conn:
+                        c = conn.cursor()
+                        c.execute("UPDATE anomalies SET statut='résolu' WHERE id=? RETURNING id_train", (sel,))
+                        # recalc health for the train of the resolved anomaly
+                        for (tid,) in c.fetchall():
+                            recalc_train_health(tid)
+                    bump_db_gen()
                     st.success("Anomalie marquée résolue et état santé recalculé.")
 
 if role == "technicien" and page == "Fiche de conformité":
     st.header("Fiche de conformité (post-intervention)")
-    conn = get_conn()
-    trains = pd.read_sql_query("SELECT id_train FROM trains", conn)['id_train'].tolist()
-    parts = pd.read_sql_query("SELECT ref, designation FROM parts", conn)
-    conn.close()
+    trains = list_trains()
     with st.form("conformity_form", clear_on_submit=True):
         train_sel = st.selectbox("Train", trains)
         typ = st.selectbox("Type d'intervention", ["préventive", "corrective"])
-        comp = st.selectbox("Composant concerné", pd.read_sql_query("SELECT name FROM components", get_conn())['name'].tolist())
-        piece = st.selectbox("Pièce remplacée (si applicable)", [""] + parts.apply(lambda r: f"{r['ref']} - {r['designation']}", axis=1).tolist())
+        comp = st.selectbox("Composant concerné", list_components())
+        piece = st.selectbox("Pièce remplacée (si applicable)", [""] + list_parts())
         result = st.selectbox("Résultat", ["Conforme", "Non conforme"])
         obs = st.text_area("Observations")
         submitted = st.form_submit_button("Enregistrer la fiche")
         if submitted:
             piece_ref = piece.split(" - ")[0] if piece else ""
-            conn = get_conn(); c = conn.cursor()
-            c.execute("""INSERT INTO conformities (
-                id_train, date_intervention, technicien, type_intervention, composant, piece_ref, resultat, observations
-            ) VALUES (?,?,?,?,?,?,?,?)""", (train_sel, now_iso(), user, typ, comp, piece_ref, result, obs))
-            conn.commit()
-            conn.close()
-            # if piece used, decrement stock
-            if piece_ref:
-                conn = get_conn(); c = conn.cursor()
-                c.execute("UPDATE parts SET qty = qty - 1 WHERE ref = ?", (piece_ref,))
-                conn.commit(); conn.close()
-            # recalc health (fixes reduce penalty)
-            new_health = recalc_train_health(train_sel)
+            with transaction() as conn:
+                c = conn.cursor()
+                c.execute("""INSERT INTO conformities (
+                    id_train, date_intervention, technicien, type_intervention, composant, piece_ref, resultat, observations
+                ) VALUES (?,?,?,?,?,?,?,?)""", (train_sel, now_iso(), user, typ, comp, piece_ref, result, obs))
+                # if piece used, decrement stock
+                if piece_ref:
+                    c.execute("UPDATE parts SET qty = qty - 1 WHERE ref = ?", (piece_ref,))
+                # recalc health (fixes reduce penalty)
+                new_health = recalc_train_health(train_sel)
+            bump_db_gen()
             st.success(f"Fiche enregistrée. État santé recalculé = {new_health}%")
 
 if role == "technicien" and page == "Historique train":
     st.header("Historique interventions par train")
-    conn = get_conn()
-    trains = pd.read_sql_query("SELECT id_train FROM trains", conn)['id_train'].tolist()
-    conn.close()
-    sel = st.selectbox("Choisir un train", trains)
+    sel = st.selectbox("Choisir un train", list_trains())
     if sel:
         df_a = df_from_query("SELECT id, date_signalement, categorie, composant, gravite, criticite_calc, statut FROM anomalies WHERE id_train=? ORDER BY date_signalement DESC", (sel,))
         df_c = df_from_query("SELECT id, date_intervention, technicien, type_intervention, composant, piece_ref, resultat FROM conformities WHERE id_train=? ORDER BY date_intervention DESC", (sel,))
@@ -401,54 +563,53 @@ if role == "technicien" and page == "Historique train":
 # ----------------------------
 if role == "responsable" and page == "Dashboard":
     st.header("Dashboard Responsable")
-    recalc_all_trains()
     # KPIs
-    df_trains = df_from_query("SELECT id_train, etat_sante FROM trains")
-    total = len(df_trains)
-    bad = len(df_trains[df_trains['etat_sante'] < 50])
-    medium = len(df_trains[(df_trains['etat_sante'] >= 50) & (df_trains['etat_sante'] < 80)])
-    good = len(df_trains[df_trains['etat_sante'] >= 80])
+    bad, medium, good, total = load_fleet_kpis(get_db_gen())
     col1, col2, col3, col4 = st.columns(4)
     col1.metric("Trains total", total)
     col2.metric("Mauvais état (<50%)", bad)
     col3.metric("État moyen (50-79%)", medium)
     col4.metric("Bon état (>=80%)", good)
     # anomalies KPIs
-    df_anom = df_from_query("SELECT * FROM anomalies")
-    open_count = len(df_anom[df_anom['statut'] != 'résolu'])
-    st.write(f"Anomalies enregistrées : {len(df_anom)} — En cours/à traiter : {open_count}")
+    total_anom, open_count = load_anomaly_kpis(get_db_gen())
+    st.write(f"Anomalies enregistrées : {total_anom} — En cours/à traiter : {open_count}")
     # plot: distribution state
-    fig = px.pie(df_trains, names='etat_sante', title="Distribution état santé (valeurs réelles)")
+    fig = px.pie(values=[bad, medium, good], names=["<50%", "50-79%", ">=80%"], title="Distribution état santé")
     st.plotly_chart(fig, use_container_width=True)
     # evolution health per train (simple historical approach: we have only current health; we will show last 90 days count)
     st.subheader("Anomalies par catégorie")
-    df_cat = df_anom.groupby("categorie").size().reset_index(name="count")
+    df_cat = load_anomalies_by_categorie(get_db_gen())
     if not df_cat.empty:
         fig2 = px.bar(df_cat, x='categorie', y='count', title="Anomalies par catégorie")
         st.plotly_chart(fig2, use_container_width=True)
     # table of trains with health + quick filters
     st.subheader("Liste des trains")
-    df_trains_disp = df_trains.copy()
-    df_trains_disp['status_color'] = df_trains_disp['etat_sante'].apply(lambda v: "🔴" if v<50 else ("🟡" if v<80 else "🟢"))
+    df_trains_disp = load_trains_health(get_db_gen()).copy()
+    v = df_trains_disp['etat_sante'].to_numpy()
+    df_trains_disp['status_color'] = np.select([v < 50, v < 80], ["🔴", "🟡"], default="🟢")
     st.dataframe(df_trains_disp.rename(columns={"id_train":"Train","etat_sante":"État santé","status_color":"Statut"}))
 
 if role == "responsable" and page == "Liste anomalies":
     st.header("Liste des anomalies")
-    df = df_from_query("SELECT id, id_train, date_signalement, technicien, categorie, composant, gravite, criticite_calc, urgence, statut FROM anomalies ORDER BY date_signalement DESC")
-    st.dataframe(df)
-    # filters
+    # filters (kept in st.session_state through the widget keys), always applied in SQL
     with st.expander("Filtres avancés"):
-        urg = st.selectbox("Urgence", ["Toutes", "critique", "moyenne", "faible"])
-        cat = st.selectbox("Catégorie", ["Toutes"] + df['categorie'].unique().tolist())
-        if st.button("Appliquer"):
-            q = "SELECT id, id_train, date_signalement, technicien, categorie, composant, gravite, criticite_calc, urgence, statut FROM anomalies WHERE 1=1"
-            params = []
-            if urg != "Toutes":
-                q += " AND urgence = ?"; params.append(urg)
-            if cat != "Toutes":
-                q += " AND categorie = ?"; params.append(cat)
-            df2 = pd.read_sql_query(q, get_conn(), params=params)
-            st.dataframe(df2)
+        urg = st.selectbox("Urgence", ["Toutes", "critique", "moyenne", "faible"], key="anom_urgence")
+        cat = st.selectbox("Catégorie", ["Toutes"] + list_categories(get_db_gen()), key="anom_categorie")
+    where = " WHERE 1=1"
+    params = []
+    if urg != "Toutes":
+        where += " AND urgence = ?"; params.append(urg)
+    if cat != "Toutes":
+        where += " AND categorie = ?"; params.append(cat)
+    total = get_conn().execute("SELECT COUNT(*) FROM anomalies" + where, params).fetchone()[0]
+    n_pages = max(1, -(-total // ANOMALIES_PAGE_SIZE))
+    if st.session_state.get("anom_page", 1) > n_pages:
+        st.session_state["anom_page"] = n_pages  # filters narrowed the result set
+    page_no = st.number_input("Page", min_value=1, max_value=n_pages, key="anom_page")
+    st.caption(f"{total} anomalies — page {page_no}/{n_pages}")
+    q = "SELECT id, id_train, date_signalement, technicien, categorie, composant, gravite, criticite_calc, urgence, statut FROM anomalies" + where + " ORDER BY date_signalement DESC LIMIT ? OFFSET ?"
+    df = df_from_query(q, params + [ANOMALIES_PAGE_SIZE, (page_no - 1) * ANOMALIES_PAGE_SIZE])
+    st.dataframe(df)
 
 if role == "responsable" and page == "Gestion pièces":
     st.header("Gestion des pièces")
@@ -461,9 +622,9 @@ if role == "responsable" and page == "Gestion pièces":
     ref = st.text_input("Référence à modifier")
     new_qty = st.number_input("Nouvelle quantité", min_value=0, value=0)
     if st.button("Mettre à jour"):
-        conn = get_conn(); c = conn.cursor()
-        c.execute("UPDATE parts SET qty=? WHERE ref=?", (new_qty, ref))
-        conn.commit(); conn.close()
+        with transaction() as conn:
+            conn.execute("UPDATE parts SET qty=? WHERE ref=?", (new_qty, ref))
+        bump_db_gen()
         st.success("Stock mis à jour")
 
 if role == "responsable" and page == "Trains & Santé":
@@ -481,7 +642,7 @@ if role == "responsable" and page == "Trains & Santé":
         st.dataframe(df_c)
         # show health
         conn = get_conn(); c = conn.cursor()
-        c.execute("SELECT etat_sante FROM trains WHERE id_train=?", (sel,)); health = c.fetchone()[0]; conn.close()
+        c.execute("SELECT etat_sante FROM trains WHERE id_train=?", (sel,)); health = c.fetchone()[0]
         st.metric("État de santé actuel", f"{health}%")
         # simple color
         color = "🔴" if health<50 else ("🟡" if health<80 else "🟢")